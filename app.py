@@ -1,12 +1,17 @@
 import streamlit as st
-import pdfplumber
-import json
+import orjson
 import requests
 import re
+import string
 import html
-from io import BytesIO
-import re
 import time
+import hashlib
+import threading
+import sqlite3
+from pathlib import Path
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 
 # --- Streamlit page setup ---
@@ -23,22 +28,233 @@ HEADERS = {
     "Content-Type": "application/json"
 }
 
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    # Shared across reruns so the TLS connection to OpenRouter is kept alive
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    return session
+
+# === LLM Response Cache ===
+# Replies embed users' W-2 fields, so rows are keyed by hash only and expire after a day
+LLM_CACHE_PATH = Path(".llm_cache") / "completions.sqlite3"
+LLM_CACHE_TTL = 24 * 60 * 60
+
+LLM_CACHE_MAX_ROWS = 1000
+
+@st.cache_resource
+def get_llm_cache() -> sqlite3.Connection:
+    """Open the cache database and create its schema once per server process."""
+    LLM_CACHE_PATH.parent.mkdir(mode=0o700, exist_ok=True)
+    # Shared by all sessions and worker threads; every statement autocommits on its own,
+    # and SQLite serializes access to the connection
+    conn = sqlite3.connect(LLM_CACHE_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS responses ("
+        "key TEXT PRIMARY KEY, response TEXT, created REAL, ts REAL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS responses_ts ON responses (ts)")
+    # Least recently used rows beyond the cap are evicted on every insert
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS responses_lru AFTER INSERT ON responses BEGIN "
+        "DELETE FROM responses WHERE key IN ("
+        f"SELECT key FROM responses ORDER BY ts DESC LIMIT -1 OFFSET {LLM_CACHE_MAX_ROWS}); "
+        "END"
+    )
+    return conn
+
+def _payload_hash(payload) -> str:
+    return hashlib.sha256(orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def llm_cache_get(payload: dict):
+    """Return the cached reply for payload, or None on a miss."""
+    key, now = _payload_hash(payload), time.time()
+    conn = get_llm_cache()
+    row = conn.execute(
+        "SELECT response FROM responses WHERE key = ? AND created > ?", (key, now - LLM_CACHE_TTL)
+    ).fetchone()
+    if row is None:
+        return None
+    conn.execute("UPDATE responses SET ts = ? WHERE key = ?", (now, key))
+    return row[0]
+
+def llm_cache_put(payload: dict, reply: str):
+    if not reply:
+        return
+    now = time.time()
+    conn = get_llm_cache()
+    conn.execute("DELETE FROM responses WHERE created <= ?", (now - LLM_CACHE_TTL,))
+    conn.execute(
+        "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (_payload_hash(payload), reply, now, now)
+    )
+
+def llm_cache_get_or_compute(payload: dict, loader) -> str:
+    """Return the cached reply for payload, or call loader() and cache its result."""
+    cached = llm_cache_get(payload)
+    if cached is not None:
+        return cached
+
+    reply = loader()
+    llm_cache_put(payload, reply)
+    return reply
+
+def _post_chat_completion(payload: dict) -> str:
+    response = get_http_session().post(OPENROUTER_URL, data=orjson.dumps(payload), timeout=30)
+    if response.status_code != 200:
+        raise requests.HTTPError(f"{response.status_code} - {response.text}", response=response)
+    return orjson.loads(response.content)["choices"][0]["message"]["content"]
+
+def _stream_chat_completion(payload: dict):
+    """Yield content deltas from an OpenRouter server-sent-events completion."""
+    with get_http_session().post(
+        OPENROUTER_URL, data=orjson.dumps({**payload, "stream": True}), stream=True, timeout=30
+    ) as response:
+        if response.status_code != 200:
+            raise requests.HTTPError(f"{response.status_code} - {response.text}", response=response)
+        for line in response.iter_lines():
+            # Skip keep-alive comments such as ": OPENROUTER PROCESSING"
+            if not line.startswith(b"data: "):
+                continue
+            data = line[len(b"data: "):]
+            if data == b"[DONE]":
+                break
+            chunk = orjson.loads(data)
+            choices = chunk.get("choices")
+            # Failures after the stream has started arrive as an error chunk, not a status code
+            if "error" in chunk or (choices and choices[0].get("finish_reason") == "error"):
+                error = chunk.get("error") or {}
+                raise requests.HTTPError(
+                    f"{error.get('code', 'stream')} - {error.get('message', 'completion failed mid-stream')}",
+                    response=response
+                )
+            if choices and (delta := choices[0]["delta"].get("content")):
+                yield delta
+
+def cached_chat_completion(payload: dict) -> str:
+    """Return the assistant reply for payload, serving repeated prompts from cache."""
+    return llm_cache_get_or_compute(payload, lambda: _post_chat_completion(payload))
+
+def stream_cached_chat_completion(payload: dict):
+    """Yield the assistant reply for payload as it arrives; cached replies are yielded whole."""
+    cached = llm_cache_get(payload)
+    if cached is not None:
+        yield cached
+        return
+
+    chunks = []
+    for chunk in _stream_chat_completion(payload):
+        chunks.append(chunk)
+        yield chunk
+    # Only completed, non-empty replies are cached; a mid-stream error raises before this
+    llm_cache_put(payload, "".join(chunks))
+
+# Greedy so nested objects in the model reply are not cut at the first closing brace
+_JSON_OBJ_RE = re.compile(r'\{.*\}', re.DOTALL)
+_NON_NUM_RE = re.compile(r'[^\d.]')
+# Deletes every Latin-1 character except ASCII digits and the decimal point
+_KEEP = set(string.digits + ".")
+_DEL_TABLE = str.maketrans("", "", "".join(chr(i) for i in range(256) if chr(i) not in _KEEP))
+
 # --- Initialize Chat Session State ---
+CHAT_HISTORY_MAXLEN = 20
+# Messages not yet in the rolling summary are sent verbatim; once twice this many
+# accumulate, all but the newest CHAT_CONTEXT_MESSAGES are folded into the summary
+CHAT_CONTEXT_MESSAGES = 6
+
 if "chat_history" not in st.session_state:
-    st.session_state.chat_history = [
+    st.session_state.chat_history = deque([
         {"role": "assistant", "content": "I'm your Tax Assistant. Ask me if you have any question."}
-    ]
+    ], maxlen=CHAT_HISTORY_MAXLEN)
+    st.session_state.chat_message_count = 1
+    st.session_state.chat_summary = ""
+    st.session_state.chat_summarized_count = 0
 
-# === PDF Processing ===
-def extract_text_from_pdf(uploaded_file) -> str:
-    with pdfplumber.open(uploaded_file) as pdf:
-        texts = [page.extract_text() for page in pdf.pages if page.extract_text()]
-    return "\n".join(texts)
+def append_chat_message(role: str, content: str):
+    st.session_state.chat_history.append({"role": role, "content": content})
+    st.session_state.chat_message_count += 1
 
+def unsummarized_chat_messages() -> list:
+    """Return the messages after the rolling summary that are still held in the history."""
+    chat_history = st.session_state.chat_history
+    pending = st.session_state.chat_message_count - st.session_state.chat_summarized_count
+    # Messages the deque has already dropped cannot be recovered, so clamp to what it still holds
+    return list(chat_history)[len(chat_history) - min(pending, len(chat_history)):]
 
+# === PDF Processing ===
+@st.cache_resource
+def get_pdfium():
+    # Imported on first upload so chat-only sessions never load PDFium
+    import pypdfium2
+    return pypdfium2
+
+@st.cache_resource
+def get_pdfium_lock() -> threading.Lock:
+    # PDFium is not thread-safe even across documents, and every browser session runs
+    # on its own script thread, so all PDFium calls in the process go through this lock
+    return threading.Lock()
+
+def _page_text(page) -> str:
+    textpage = page.get_textpage()
+    try:
+        return textpage.get_text_range()
+    finally:
+        textpage.close()
+        page.close()
+
+@st.cache_data(show_spinner=False)
+def extract_text_from_pdf(file_bytes: bytes) -> str:
+    # Keyed on the raw bytes so reruns (and identical uploads) skip PDFium
+    pdfium = get_pdfium()
+    with get_pdfium_lock():
+        pdf = pdfium.PdfDocument(file_bytes)
+        try:
+            texts = [t for page in pdf if (t := _page_text(page))]
+        finally:
+            pdf.close()
+    # PDFium separates lines with CRLF
+    return "\n".join(texts).replace("\r\n", "\n")
+
+
+
+# === Deterministic Field Extraction ===
+# Amounts must sit on the same line as their box label; names are read from the line below it
+_W2_AMOUNT = r"[^\d\n]*?\$?[ \t]*([\d,]+\.\d{2})"
+_W2_NAME = r"[^\n]*\n[ \t]*([^\d\n]+?)[ \t]*$"
+_W2_PATTERNS = {
+    "Employee Name": re.compile(r"Employee['’]?s\s+(?:first\s+)?name" + _W2_NAME, re.I | re.M),
+    "Employer Name": re.compile(r"Employer['’]?s\s+name" + _W2_NAME, re.I | re.M),
+    "Wages (Box 1)": re.compile(
+        r"(?:Wages,\s*tips,\s*other\s+comp(?:ensation)?|\bBox\s*1\b)" + _W2_AMOUNT, re.I),
+    "Federal Income Tax Withheld (Box 2)": re.compile(
+        r"(?:Federal\s+income\s+tax\s+withheld|\bBox\s*2\b)" + _W2_AMOUNT, re.I),
+    "Social Security Wages (Box 3)": re.compile(
+        r"(?:Social\s+security\s+wages|\bBox\s*3\b)" + _W2_AMOUNT, re.I),
+    "Filing Year": re.compile(r"Wage\s+and\s+Tax\s+Statement[^\d\n]*((?:19|20)\d{2})\b", re.I),
+}
+_W2_NAME_FIELDS = ("Employee Name", "Employer Name")
+# In column-wise layouts the line below a name label is often the next box label
+_W2_LABEL_RE = re.compile(
+    r"^[a-f]\s|Employe[er]['’]?s\b|Control\s+number|\b(?:name|address|ZIP\s+code)\b", re.I
+)
+
+def extract_fields_with_regex(text: str) -> dict:
+    """Return the W-2 fields found at their fixed box labels; unmatched fields are omitted."""
+    fields = {}
+    for field, pattern in _W2_PATTERNS.items():
+        match = pattern.search(text)
+        if not match:
+            continue
+        value = match.group(1).strip()
+        if field in _W2_NAME_FIELDS and _W2_LABEL_RE.search(value):
+            continue
+        fields[field] = value
+    return fields
 
 # === Field Extraction with LLM ===
-def extract_fields_from_text(text: str) -> dict:
+def request_fields_from_text(text: str) -> str:
+    """Return the model's raw field-extraction reply; safe to run off the script thread."""
     system_message = (
         "You are a helpful AI assistant that extracts structured tax information from W-2 form text. "
         "Return only a valid JSON object with the following keys:\n"
@@ -67,33 +283,31 @@ Extract the fields and respond only with JSON.
         ]
     }
 
-    with st.spinner("🧠 Extracting fields ..."):
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=HEADERS,
-            json=payload,
-            timeout=30
-        )
+    return cached_chat_completion(payload)
+
+def extract_fields_from_text(text: str, pending_reply: Future = None) -> dict:
+    """Parse W-2 fields from the model reply, awaiting pending_reply if it was already requested."""
+    try:
+        with st.spinner("🧠 Extracting fields ..."):
+            reply = pending_reply.result() if pending_reply else request_fields_from_text(text)
+    except requests.HTTPError as e:
+        st.error(f"❌ OpenRouter API failed: {e}")
+        return {}
 
-    if response.status_code == 200:
-        reply = response.json()["choices"][0]["message"]["content"]
-        st.text_area("📝 Raw model output", reply, height=200)
+    st.text_area("📝 Raw model output", reply, height=200)
 
-        match = re.search(r'\{.*?\}', reply, re.DOTALL)
-        if match:
-            json_str = match.group()
-            try:
-                parsed = json.loads(json_str)
-                st.success("✅ Successfully parsed tax fields.")
-                return parsed
-            except json.JSONDecodeError as e:
-                st.warning(f"⚠️ JSON decoding failed: {str(e)}")
-                return {}
-        else:
-            st.warning("⚠️ No JSON object found in model reply.")
+    match = _JSON_OBJ_RE.search(reply)
+    if match:
+        json_str = match.group()
+        try:
+            parsed = orjson.loads(json_str)
+            st.success("✅ Successfully parsed tax fields.")
+            return parsed
+        except orjson.JSONDecodeError as e:
+            st.warning(f"⚠️ JSON decoding failed: {str(e)}")
             return {}
     else:
-        st.error(f"❌ OpenRouter API failed: {response.status_code}\n{response.text}")
+        st.warning("⚠️ No JSON object found in model reply.")
         return {}
 
 # --- Basic Input Sanitization for safety ---
@@ -107,7 +321,10 @@ def compute_tax_summary(data: dict, filing_status: str, additional_deductions: f
     def safe_float(value):
         if isinstance(value, str):
             # Remove commas and any other non-numeric characters (except the decimal point)
-            cleaned_value = ''.join(c for c in value if c.isdigit() or c == '.')
+            cleaned_value = value.translate(_DEL_TABLE)
+            if not cleaned_value.isascii():
+                # Characters beyond Latin-1 are not in the table
+                cleaned_value = _NON_NUM_RE.sub('', cleaned_value)
             try:
                 return float(cleaned_value)
             except (ValueError, TypeError):
@@ -169,142 +386,216 @@ def compute_tax_summary(data: dict, filing_status: str, additional_deductions: f
     except Exception as e:
         st.error(f"Error in tax computation: {e}")
         return {}
-def generate_tax_return_html(summary: dict) -> str:
-    esc = lambda x: html.escape(str(x))
-    html_content = f"""
+_TAX_RETURN_HTML = string.Template("""
     <html>
     <head>
-        <title>Tax Return - {esc(summary.get('Filing Year',''))}</title>
+        <title>Tax Return - $filing_year</title>
     </head>
     <body style="font-family: sans-serif; background-color: #111; color: #fff; padding: 20px;">
-        <p><strong>Employee Name:</strong> {esc(summary.get('Employee Name',''))}</p>
-        <p><strong>Employer Name:</strong> {esc(summary.get('Employer Name',''))}</p>
-        <p><strong>Filing Year:</strong> {esc(summary.get('Filing Year',''))}</p>
-        <p><strong>Filing Status:</strong> {esc(summary.get('Filing Status',''))}</p>
-        <p><strong>Total Income:</strong> ${esc(summary.get('Total Income',0))}</p>
-        <p><strong>Standard Deduction + Additional:</strong> ${esc(summary.get('Standard Deduction + Additional',0))}</p>
-        <p><strong>Taxable Income:</strong> ${esc(summary.get('Taxable Income',0))}</p>
-        <p><strong>Estimated Tax Owed:</strong> ${esc(summary.get('Estimated Tax Owed',0))}</p>
-        <p><strong>Tax Withheld:</strong> ${esc(summary.get('Tax Withheld',0))}</p>
-        <p><strong>Refund or Amount Due:</strong> ${esc(summary.get('Refund or Amount Due',0))}</p>
-        <h3>{esc(summary.get('Status Message',''))}</h3>
+        <p><strong>Employee Name:</strong> $employee_name</p>
+        <p><strong>Employer Name:</strong> $employer_name</p>
+        <p><strong>Filing Year:</strong> $filing_year</p>
+        <p><strong>Filing Status:</strong> $filing_status</p>
+        <p><strong>Total Income:</strong> $$$total_income</p>
+        <p><strong>Standard Deduction + Additional:</strong> $$$deduction</p>
+        <p><strong>Taxable Income:</strong> $$$taxable_income</p>
+        <p><strong>Estimated Tax Owed:</strong> $$$tax_owed</p>
+        <p><strong>Tax Withheld:</strong> $$$tax_withheld</p>
+        <p><strong>Refund or Amount Due:</strong> $$$refund_or_due</p>
+        <h3>$status_message</h3>
     </body>
     </html>
-    """
-    return html_content
+    """)
+
+@st.cache_data(show_spinner=False)
+def generate_tax_return_html(summary: dict) -> str:
+    esc = lambda x: html.escape(str(x))
+    return _TAX_RETURN_HTML.substitute(
+        filing_year=esc(summary.get('Filing Year','')),
+        employee_name=esc(summary.get('Employee Name','')),
+        employer_name=esc(summary.get('Employer Name','')),
+        filing_status=esc(summary.get('Filing Status','')),
+        total_income=esc(summary.get('Total Income',0)),
+        deduction=esc(summary.get('Standard Deduction + Additional',0)),
+        taxable_income=esc(summary.get('Taxable Income',0)),
+        tax_owed=esc(summary.get('Estimated Tax Owed',0)),
+        tax_withheld=esc(summary.get('Tax Withheld',0)),
+        refund_or_due=esc(summary.get('Refund or Amount Due',0)),
+        status_message=esc(summary.get('Status Message',''))
+    )
 
 
 
 # === Chatbot Response ===
-def assistant_respond_with_llm(user_input):
-    chat_history = st.session_state.chat_history
+# Replies are rendered as-is, so formatting is requested up front instead of fixed afterwards
+RESPONSE_FORMAT_INSTRUCTION = "Respond in clean Markdown with proper spacing, punctuation, and paragraph breaks."
+
+def update_chat_summary():
+    """Fold older unsummarized messages into the rolling summary once enough have accumulated."""
+    pending = unsummarized_chat_messages()
+    if len(pending) < 2 * CHAT_CONTEXT_MESSAGES:
+        return
+
+    batch = pending[:-CHAT_CONTEXT_MESSAGES]
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in batch)
+    payload = {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": (
+                "Summarize this conversation between a user and a tax assistant in a few sentences. "
+                "Keep any figures, filing details, and open questions; respond with the summary only."
+            )},
+            {"role": "user", "content": f"Summary so far: {st.session_state.chat_summary or 'none'}\n\n{transcript}"}
+        ]
+    }
+    try:
+        with st.spinner("📝 Summarizing the conversation..."):
+            st.session_state.chat_summary = cached_chat_completion(payload)
+    except (requests.RequestException, KeyError, IndexError, orjson.JSONDecodeError):
+        # API failure or a malformed 200 body: keep the previous summary and
+        # retry with a larger batch after the next turn
+        return
+    st.session_state.chat_summarized_count = st.session_state.chat_message_count - CHAT_CONTEXT_MESSAGES
+
+def assistant_respond_with_llm():
+    """Yield the assistant's reply to the latest user message in chunks as it streams in."""
+    recent = unsummarized_chat_messages()
+    chat_summary = st.session_state.chat_summary
     system_prompt = (
         "You are a friendly and knowledgeable AI Tax Assistant helping a user step-by-step with their tax return. "
-        "Guide them through W-2 upload, review, deductions, calculation, and download."
+        "Guide them through W-2 upload, review, deductions, calculation, and download. "
+        + RESPONSE_FORMAT_INSTRUCTION
     )
 
-    messages = [{"role": "system", "content": system_prompt}] + chat_history + [{"role": "user", "content": user_input}]
+    messages = [{"role": "system", "content": system_prompt}]
+    if chat_summary:
+        messages.append({"role": "system", "content": f"Summary so far: {chat_summary}"})
+    # The history already ends with the user's new message
+    messages += recent
     payload = {"model": MODEL, "messages": messages}
 
     try:
-        with st.spinner("💬 Thinking..."):
-            response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=HEADERS, json=payload, timeout=30)
-        if response.status_code == 200:
-            return response.json()["choices"][0]["message"]["content"]
-        else:
-            return f"❌ Error: {response.status_code} - {response.text}"
+        yield from stream_cached_chat_completion(payload)
+    except requests.HTTPError as e:
+        yield f"❌ Error: {e}"
     except Exception as e:
-        return f"⚠️ Failed to reach the assistant: {str(e)}"
+        yield f"⚠️ Failed to reach the assistant: {str(e)}"
 
 # === QA Chatbot (Tax Info) ===
-def tax_qa_assistant_respond(question: str) -> str:
+# Tax data sent with each question. Names and year come from the raw W-2 fields, since the
+# summary holds HTML-escaped copies; the summary contributes only computed values.
+QA_CONTEXT_FIELDS = {
+    "Extracted W-2 Data": (
+        "Employee Name", "Employer Name", "Filing Year", "Social Security Wages (Box 3)"
+    ),
+    "Tax Summary": (
+        "Filing Status", "Total Income", "Standard Deduction + Additional", "Taxable Income",
+        "Estimated Tax Owed", "Tax Withheld", "Refund or Amount Due", "Status Message"
+    )
+}
+
+def tax_qa_assistant_respond(question: str):
+    """Yield the answer in chunks as it streams in."""
     extracted = st.session_state.get("extracted_data", {})
     summary = st.session_state.get("summary", {})
 
     context = {
-        "Extracted W-2 Data": extracted,
-        "Tax Summary": summary
+        section: {k: v for k, v in data.items() if k in QA_CONTEXT_FIELDS[section] and v not in ("", None)}
+        for section, data in (("Extracted W-2 Data", extracted), ("Tax Summary", summary))
     }
 
     system_prompt = (
         "You are an AI tax expert helping the user understand their tax situation. "
-        "You have access to their W-2 data and tax summary. Answer clearly and accurately based on it."
+        "You have access to their W-2 data and tax summary. Answer clearly and accurately based on it. "
+        + RESPONSE_FORMAT_INSTRUCTION
     )
 
     payload = {
         "model": MODEL,
         "messages": [
             {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"User tax data:\n{json.dumps(context, indent=2)}"},
+            {"role": "user", "content": f"User tax data:\n{orjson.dumps({k: v for k, v in context.items() if v}).decode()}"},
             {"role": "user", "content": f"User question: {question}"}
         ]
     }
 
     try:
-        with st.spinner("🧮 Thinking..."):
-            response = requests.post("https://openrouter.ai/api/v1/chat/completions", headers=HEADERS, json=payload, timeout=30)
-        if response.status_code == 200:
-            return response.json()["choices"][0]["message"]["content"]
-        else:
-            return f"❌ Error: {response.status_code} - {response.text}"
+        yield from stream_cached_chat_completion(payload)
+    except requests.HTTPError as e:
+        yield f"❌ Error: {e}"
     except Exception as e:
-        return f"⚠️ Failed to answer: {str(e)}"
+        yield f"⚠️ Failed to answer: {str(e)}"
 
 # === Main App ===
-st.markdown("### Upload your W-2 PDF file")
-uploaded_file = st.file_uploader("Please upload a W-2 PDF file to get started.", type=["pdf"], key="w2_uploader")
-
-# View 2: Show the final summary if it's already calculated
-if "summary" in st.session_state:
-    summary = st.session_state["summary"]
-    #st.subheader("📊 Tax Summary")
-    #st.json(summary)
-
-    tax_return_html = generate_tax_return_html(summary)
-    st.markdown("---")
-    st.markdown("### 🧾 Your Tax Return Form")
-    st.components.v1.html(tax_return_html, height=450, scrolling=True)
-
-    buf = BytesIO()
-    buf.write(tax_return_html.encode('utf-8'))
-    buf.seek(0)
-    st.download_button(
-        "📥 Download Tax Return Form", 
-        data=buf,
-        file_name=f"tax_return_{summary.get('Filing Year','')}.html", 
-        mime="text/html"
-    )
-    
-    if "raw_text" in st.session_state:
-        with st.expander("🔍 View Extracted W-2 Text"):
-            st.text(st.session_state["raw_text"])
-
-# View 1: Show the calculation form if a file is uploaded but not yet summarized
-elif uploaded_file:
-    with st.spinner("📄 Reading and extracting text from W-2..."):
-        raw_text = extract_text_from_pdf(uploaded_file)
-        st.session_state["raw_text"] = raw_text
-
-    extracted_data = extract_fields_from_text(raw_text)
-    if extracted_data:
-        st.session_state["extracted_data"] = extracted_data
-        st.markdown("### Provide additional tax info")
-
-        filing_status = st.selectbox("Select your Filing Status", options=[
-            "single", "married_filing_jointly", "married_filing_separately", "head_of_household"])
-        
-        additional_deductions = st.number_input("Additional Deductions", min_value=0.0, step=100.0, value=0.0)
-
-        if st.button("Calculate Tax"):
-            with st.spinner("💰 Calculating your tax summary..."):
-                summary = compute_tax_summary(extracted_data, filing_status, additional_deductions)
-            if summary:
-                st.session_state["summary"] = summary
-                st.rerun()  # Rerun to switch to the summary view
-    else:
-        st.error("⚠️ Failed to extract fields from the W-2 form. Please check your file or try another.")
-#else:
-    #st.info("Please upload a W-2 PDF file to get started.")
+@st.fragment
+def render_tax_views():
+    # A fragment, so the upload and calculation widgets rerun only this view, not the chat below
+    st.markdown("### Upload your W-2 PDF file")
+    uploaded_file = st.file_uploader("Please upload a W-2 PDF file to get started.", type=["pdf"], key="w2_uploader")
+
+    # View 2: Show the final summary if it's already calculated
+    if "summary" in st.session_state:
+        summary = st.session_state["summary"]
+        tax_return_html = generate_tax_return_html(summary)
+        st.markdown("---")
+        st.markdown("### 🧾 Your Tax Return Form")
+        st.components.v1.html(tax_return_html, height=450, scrolling=True)
+
+        st.download_button(
+            "📥 Download Tax Return Form", 
+            data=tax_return_html,
+            file_name=f"tax_return_{summary.get('Filing Year','')}.html", 
+            mime="text/html"
+        )
+
+        if "raw_text" in st.session_state:
+            with st.expander("🔍 View Extracted W-2 Text"):
+                st.text(st.session_state["raw_text"])
+
+    # View 1: Show the calculation form if a file is uploaded but not yet summarized
+    elif uploaded_file:
+        with st.spinner("📄 Reading and extracting text from W-2..."):
+            raw_text = extract_text_from_pdf(uploaded_file.getvalue())
+            st.session_state["raw_text"] = raw_text
+
+        w2_fields = extract_fields_with_regex(raw_text)
+        missing_fields = [f for f in _W2_PATTERNS if f not in w2_fields]
+
+        # Only fall back to the model when the regex pass left fields blank, and request them
+        # in the background while the raw text is shown
+        with ThreadPoolExecutor(
+            max_workers=1, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())
+        ) as ex:
+            pending_reply = ex.submit(request_fields_from_text, raw_text) if missing_fields else None
+            with st.expander("🔍 View Extracted W-2 Text"):
+                st.text(raw_text)
+            if missing_fields:
+                llm_fields = extract_fields_from_text(raw_text, pending_reply)
+                # Regex amounts override the model, but the model reads names more reliably
+                llm_names = {f: llm_fields[f] for f in _W2_NAME_FIELDS if llm_fields.get(f)}
+                extracted_data = {**llm_fields, **w2_fields, **llm_names}
+            else:
+                extracted_data = w2_fields
+
+        if extracted_data:
+            st.session_state["extracted_data"] = extracted_data
+            st.markdown("### Provide additional tax info")
+
+            filing_status = st.selectbox("Select your Filing Status", options=[
+                "single", "married_filing_jointly", "married_filing_separately", "head_of_household"])
+
+            additional_deductions = st.number_input("Additional Deductions", min_value=0.0, step=100.0, value=0.0)
+
+            if st.button("Calculate Tax"):
+                with st.spinner("💰 Calculating your tax summary..."):
+                    summary = compute_tax_summary(extracted_data, filing_status, additional_deductions)
+                if summary:
+                    st.session_state["summary"] = summary
+                    st.rerun()  # Full app rerun to switch to the summary view
+        else:
+            st.error("⚠️ Failed to extract fields from the W-2 form. Please check your file or try another.")
+
+render_tax_views()
 
 # === Chat Interface (always at the bottom) ===
 st.markdown("---")
@@ -318,37 +609,22 @@ for message in st.session_state.chat_history:
 # Main chat input
 if user_input := st.chat_input("Ask a question about your taxes..."):
     # Add user message to history and display it
-    st.session_state.chat_history.append({"role": "user", "content": user_input})
+    append_chat_message("user", user_input)
     with st.chat_message("user"):
         st.markdown(user_input)
 
-    # Get and display assistant's response
+    # Stream the assistant's response as it arrives
     with st.chat_message("assistant"):
         # Use the appropriate assistant based on context
         if "summary" in st.session_state:
-            response = tax_qa_assistant_respond(user_input)
+            stream = tax_qa_assistant_respond(user_input)
         else:
-            response = assistant_respond_with_llm(user_input)
-    
-        def clean_model_response(text):
-            # Escape markdown characters
-            text = re.sub(r'([*_`])', r'\\\1', text)
-            text = re.sub(r'(\d)([a-zA-Z])', r'\1 \2', text)
-            text = re.sub(r'([a-zA-Z])(\d)', r'\1 \2', text)
-            return text.replace("\n", "  \n")
-    
-        escaped = clean_model_response(response)
-    
-        # Typing effect simulation
-        placeholder = st.empty()
-        displayed_text = ""
-        for word in escaped.split():
-            displayed_text += word + " "
-            placeholder.markdown(displayed_text)
-            time.sleep(0.05)  # Adjust speed here
-            
-        
+            stream = assistant_respond_with_llm()
 
+        response = st.write_stream(stream)
     
     # Add assistant response to history
-    st.session_state.chat_history.append({"role": "assistant", "content": response})
+    append_chat_message("assistant", response)
+    # The Q&A assistant answers from the tax data alone, so it needs no summary of the history
+    if "summary" not in st.session_state:
+        update_chat_summary()